@@ -1,11 +1,22 @@
 import asyncio
-import json
+import hashlib
+import heapq
 import os
-import random
 import string
 import re
+import time
 from datetime import datetime, timedelta
+from functools import lru_cache
+from itertools import chain
+import orjson
+from curl_cffi import CurlHttpVersion
 from curl_cffi.requests import AsyncSession
+from curl_cffi.requests.exceptions import RequestException
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
 
 # --- CONFIGURATION ---
 
@@ -22,43 +33,239 @@ EXCLUSION_KEYWORDS = [
     "academy", "castilla", "femminile", "liga f", "serie c"
 ]
 
+FEATURED_TEAMS_LC = tuple(t.lower() for t in FEATURED_TEAMS)
+EXCLUSION_KEYWORDS_LC = tuple(w.lower() for w in EXCLUSION_KEYWORDS)
+
 API_BASE = "https://api.sofascore.com/api/v1"
 FILE_PATH = "api/highlights.json"
+MAX_ITEMS = 200
+CACHE_DIR = "api/.cache"
+ETAG_PATH = os.path.join(CACHE_DIR, "etags.json")
+PURGE_PATH = os.path.join(CACHE_DIR, "purge_ids.json")
+BODY_DIR = os.path.join(CACHE_DIR, "bodies")
+
+# Max in-flight requests against Sofascore
+MAX_CONCURRENCY = 8
+
+REQUEST_TIMEOUT = 15
+# Hard deadline around each request in case curl never returns
+REQUEST_DEADLINE = 20
+MAX_RETRIES = 3
+
+# Failures a single fetch may swallow; cancellation and interrupts still propagate
+FETCH_ERRORS = (RequestException, asyncio.TimeoutError, OSError, ValueError)
 
-YT_REGEX = re.compile(r"(?:v=|\/|vi\/|embed\/)([A-Za-z0-9_-]{11})")
+# How long ETag bodies and restricted ids are kept. Only yesterday's and
+# today's matches are ever looked up, so a week is plenty
+CACHE_TTL = 7 * 86400
+_FINISHED = frozenset(("finished", "ended"))
+
+YT_REGEX = re.compile(r"(?:v=|\/|vi\/|embed\/)([A-Za-z0-9_-]{11})", re.ASCII)
+YT_REGEX_SEARCH = YT_REGEX.search
+YT_ID_MARKERS = ("?v=", "&v=", "youtu.be/", "/embed/", "/vi/", "/shorts/")
+YT_ID_CHARS = frozenset(string.ascii_letters + string.digits + "_-")
 
 # --- UTILITIES ---
 
-def generate_custom_id():
-    return ''.join(random.choices(string.ascii_lowercase, k=4)) + ''.join(random.choices(string.digits, k=6))
+def build_automaton(groups):
+    automaton = ahocorasick.Automaton()
+    for kind, words in groups.items():
+        for word in words:
+            automaton.add_word(word, (kind, word))
+    automaton.make_automaton()
+    return automaton
+
+KEYWORD_AUTOMATON = build_automaton({
+    "featured": FEATURED_TEAMS_LC,
+    "excluded": EXCLUSION_KEYWORDS_LC,
+}) if ahocorasick else None
+
+# Fallback when pyahocorasick is not installed
+FEATURED_REGEX = re.compile("|".join(map(re.escape, FEATURED_TEAMS_LC)))
+EXCLUSION_REGEX = re.compile("|".join(map(re.escape, EXCLUSION_KEYWORDS_LC)))
 
+def generate_custom_id():
+    # Same shape as before (4 letters + 6 digits) from urandom bytes. Bytes at or
+    # above the largest multiple of 26/10 are rejected so every symbol is equally likely
+    letters, digits = [], []
+    while len(digits) < 6:
+        for b in os.urandom(16):
+            if len(letters) < 4:
+                if b < 234:
+                    letters.append(string.ascii_lowercase[b % 26])
+            elif len(digits) < 6 and b < 250:
+                digits.append(string.digits[b % 10])
+    return ''.join(letters + digits)
+
+@lru_cache(maxsize=4096)
 def clean_team_name(name):
     return name.replace('-', ' ').replace('FC', '').replace('fc', '').strip()
 
+@lru_cache(maxsize=4096)
 def get_yt_id(url):
-    m = YT_REGEX.search(url)
+    # Plain substring lookups cover the usual link shapes; the regex handles the rest.
+    # The leftmost marker wins, so a later query parameter cannot override the path id
+    found = None
+    found_at = len(url)
+    for marker in YT_ID_MARKERS:
+        i = url.find(marker, 0, found_at)
+        if i != -1:
+            start = i + len(marker)
+            vid = url[start:start + 11]
+            if len(vid) == 11 and YT_ID_CHARS.issuperset(vid):
+                found, found_at = vid, i
+
+    if found:
+        return found
+
+    m = YT_REGEX_SEARCH(url)
     return m.group(1) if m else None
 
+@lru_cache(maxsize=4096)
+def is_priority(team1, team2, category):
+    t1 = team1.lower()
+    t2 = team2.lower()
+    cat = category.lower()
+
+    # "|" keeps a keyword from matching across two fields;
+    # featured teams only count in the team names, exclusions anywhere
+    if KEYWORD_AUTOMATON is None:
+        return (EXCLUSION_REGEX.search(f"{t1}|{t2}|{cat}") is None
+                and FEATURED_REGEX.search(f"{t1}|{t2}") is not None)
+
+    teams_end = len(t1) + 1 + len(t2)
+    featured = False
+
+    for end, (kind, _) in KEYWORD_AUTOMATON.iter(f"{t1}|{t2}|{cat}"):
+        if kind == "excluded":
+            return False
+        if end < teams_end:
+            featured = True
+
+    return featured
+
 def is_priority_match(item):
-    t1 = item.get("team1", "").lower()
-    t2 = item.get("team2", "").lower()
-    cat = item.get("category", "").lower()
+    return is_priority(item.get("team1", ""), item.get("team2", ""), item.get("category", ""))
+
+# Dates are UTC days, which is also the runner's local time
+@lru_cache(maxsize=2048)
+def day_string(day_index):
+    t = time.gmtime(day_index * 86400)
+    return "%04d-%02d-%02d" % (t.tm_year, t.tm_mon, t.tm_mday)
+
+# --- RESPONSE CACHE ---
 
-    if any(x in t1 or x in t2 or x in cat for x in EXCLUSION_KEYWORDS):
-        return False
+# url -> {"etag", "last_modified", "body"}, loaded and saved by main()
+etag_index = {}
 
-    return any(t in t1 or t in t2 for t in FEATURED_TEAMS)
+def write_atomic(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def load_etags():
+    try:
+        with open(ETAG_PATH, "rb") as f:
+            etag_index.update(orjson.loads(f.read()))
+    except (OSError, ValueError):
+        pass
+
+def save_etags():
+    write_atomic(ETAG_PATH, orjson.dumps(etag_index))
+
+# video id -> first time it was seen restricted
+def load_purge_ids(ttl):
+    try:
+        with open(PURGE_PATH, "rb") as f:
+            stored = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+    cutoff = time.time() - ttl
+    return {vid: seen for vid, seen in stored.items() if seen >= cutoff}
+
+def save_purge_ids(purge_ids):
+    write_atomic(PURGE_PATH, orjson.dumps(purge_ids))
+
+def prune_cache(ttl):
+    cutoff = time.time() - ttl
+    try:
+        entries = list(os.scandir(BODY_DIR))
+    except OSError:
+        entries = []
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+    for url, entry in list(etag_index.items()):
+        if not os.path.exists(entry.get("body", "")):
+            del etag_index[url]
+
+def retry_delay(response, attempt):
+    try:
+        return min(float(response.headers.get("Retry-After")), 30)
+    except (TypeError, ValueError):
+        return 2 ** attempt
+
+async def fetch_json(session, sem, url, needle=None):
+    entry = etag_index.get(url)
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    for attempt in range(MAX_RETRIES + 1):
+        async with sem:
+            r = await asyncio.wait_for(session.get(url, headers=headers), REQUEST_DEADLINE)
+        if (r.status_code != 429 and r.status_code < 500) or attempt == MAX_RETRIES:
+            break
+        await asyncio.sleep(retry_delay(r, attempt))
+
+    if r.status_code == 304 and entry:
+        try:
+            with open(entry["body"], "rb") as f:
+                body = f.read()
+        except OSError:
+            etag_index.pop(url, None)
+            return None
+    elif r.status_code == 200:
+        body = r.content
+        etag = r.headers.get("ETag")
+        last_modified = r.headers.get("Last-Modified")
+        if etag or last_modified:
+            body_path = os.path.join(BODY_DIR, hashlib.sha1(url.encode()).hexdigest() + ".json")
+            write_atomic(body_path, body)
+            etag_index[url] = {"etag": etag, "last_modified": last_modified, "body": body_path}
+    else:
+        return None
+
+    # A plain byte scan is enough to rule out payloads we would discard anyway
+    if needle and needle not in body:
+        return None
+
+    try:
+        return orjson.loads(body)
+    except ValueError:
+        etag_index.pop(url, None)
+        return None
 
 # --- INCIDENTS (GOALS ONLY) ---
 
-async def get_goals(session, match_id):
+async def get_goals(session, sem, match_id):
     url = f"{API_BASE}/event/{match_id}/incidents"
     try:
-        res = await session.get(url, impersonate="chrome120", timeout=10)
-        if res.status_code != 200:
-            return None
-        data = res.json()
-    except:
+        data = await fetch_json(session, sem, url)
+    except FETCH_ERRORS:
+        return None
+
+    if not data:
         return None
 
     home, away = [], []
@@ -68,7 +275,7 @@ async def get_goals(session, match_id):
             continue
 
         goal = {
-            "name": inc.get("player", {}).get("name", "Unknown"),
+            "name": (inc.get("player") or {}).get("name", "Unknown"),
             "time": f"{inc.get('time', '')}'"
         }
 
@@ -87,119 +294,184 @@ async def get_goals(session, match_id):
 
 # --- SCRAPER LOGIC ---
 
-async def get_matches(session, date_str):
+async def get_matches(session, sem, date_str):
     url = f"{API_BASE}/sport/football/scheduled-events/{date_str}"
     try:
-        r = await session.get(url, impersonate="chrome120", timeout=15)
-        if r.status_code == 200:
-            return r.json().get("events", [])
-    except:
+        data = await fetch_json(session, sem, url)
+        if data:
+            return data.get("events", [])
+    except FETCH_ERRORS:
         pass
     return []
 
-async def get_highlights(session, match_id):
+async def get_highlights(session, sem, match_id):
     url = f"{API_BASE}/event/{match_id}/highlights"
     try:
-        r = await session.get(url, impersonate="chrome120", timeout=10)
-        if r.status_code == 200:
-            return r.json().get("highlights", [])
-    except:
+        data = await fetch_json(session, sem, url, needle=b"youtu")
+        if data:
+            return data.get("highlights", [])
+    except FETCH_ERRORS:
         pass
     return []
 
-async def process_match(session, match):
+async def process_match(session, sem, match, stored=False):
     match_id = match["id"]
-    highlights = await get_highlights(session, match_id)
-    if not highlights:
-        return None, set()
 
-    goals = await get_goals(session, match_id)
-    if not goals:
+    # Re-read every run: the "Highlights"/"Extended" video is often added after
+    # other clips. Conditional GETs keep unchanged lists from being re-downloaded
+    highlights = await get_highlights(session, sem, match_id)
+    if not highlights:
         return None, set()
 
-    restricted_ids = set()
-    valid_item = None
+    restricted_ids = {
+        get_yt_id(h.get("url") or h.get("sourceUrl", ""))
+        for h in highlights if h.get("forCountries")
+    } - {None}
 
+    valid_vid = None
     for h in highlights:
-        url = h.get("url") or h.get("sourceUrl", "")
-        vid = get_yt_id(url)
-        if not vid:
-            continue
-
         if h.get("forCountries"):
-            restricted_ids.add(vid)
             continue
 
         subtitle = h.get("subtitle", "").lower()
-        if not valid_item and ("highlights" in subtitle or "extended" in subtitle):
-            valid_item = {
-                "id": generate_custom_id(),
-                "match_id": match_id,
-                "team1": clean_team_name(match["homeTeam"]["name"]),
-                "team2": clean_team_name(match["awayTeam"]["name"]),
-                "category": match.get("tournament", {}).get("name", "Football"),
-                "date": datetime.fromtimestamp(match["startTimestamp"]).strftime("%Y-%m-%d"),
-                **goals,
-                "link": f"https://www.youtube.com/watch?v={vid}"
-            }
+        if "highlights" not in subtitle and "extended" not in subtitle:
+            continue
+
+        valid_vid = get_yt_id(h.get("url") or h.get("sourceUrl", ""))
+        if valid_vid:
+            break
+
+    # Incidents are only worth fetching once there is a highlight to attach them to
+    # Stored matches are only re-checked for newly restricted videos
+    if stored or not valid_vid:
+        return None, restricted_ids
+
+    goals = await get_goals(session, sem, match_id)
+    if not goals:
+        return None, restricted_ids
+
+    valid_item = {
+        "id": generate_custom_id(),
+        "match_id": match_id,
+        "team1": clean_team_name(match["homeTeam"]["name"]),
+        "team2": clean_team_name(match["awayTeam"]["name"]),
+        "category": match.get("tournament", {}).get("name", "Football"),
+        "date": day_string(match["startTimestamp"] // 86400),
+        **goals,
+        "link": f"https://www.youtube.com/watch?v={valid_vid}"
+    }
 
     return valid_item, restricted_ids
 
+# --- OUTPUT ---
+
+def save_highlights(items, path):
+    # The window is chosen by recency so new matches always get in and old ones
+    # age out; priority only decides the order inside it. Tuples compare in C,
+    # and -position keeps earlier items first on ties so dicts are never compared
+    dated = [(it.get("date", "1970-01-01"), -i, it) for i, it in enumerate(items)]
+    window = heapq.nlargest(MAX_ITEMS, dated)
+
+    decorated = [(is_priority_match(it), day, pos, it) for day, pos, it in window]
+    decorated.sort(reverse=True)
+    final = [t[3] for t in decorated]
+
+    # Compact output in one write, swapped in so readers never see a partial file
+    write_atomic(path, orjson.dumps(final))
+
+    return len(final)
+
 # --- MAIN ENGINE ---
 
 async def main():
     os.makedirs("api", exist_ok=True)
 
+    # A missing, blank or corrupt file just means starting from scratch
     existing = []
-    if os.path.exists(FILE_PATH):
-        with open(FILE_PATH, "r", encoding="utf-8") as f:
-            existing = json.load(f)
+    try:
+        with open(FILE_PATH, "rb") as f:
+            existing = orjson.loads(f.read())
+    except (OSError, ValueError):
+        pass
+
+    load_etags()
+    prune_cache(CACHE_TTL)
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
 
-    async with AsyncSession() as session:
+    async with AsyncSession(
+        impersonate="chrome120",
+        timeout=REQUEST_TIMEOUT,
+        http_version=CurlHttpVersion.V2_0,
+        max_clients=MAX_CONCURRENCY
+    ) as session:
         today = datetime.now()
         dates = [
             (today - timedelta(days=1)).strftime("%Y-%m-%d"),
             today.strftime("%Y-%m-%d")
         ]
 
-        events = []
-        for d in dates:
-            events.extend(await get_matches(session, d))
+        pages = await asyncio.gather(*[get_matches(session, sem, d) for d in dates])
+        events = [e for page in pages for e in page]
 
-        finished = [e for e in events if e.get("status", {}).get("type") in ("finished", "ended")]
+        # One pass: keep finished events, once each (the two date pages can overlap)
+        finished = []
+        seen_events = set()
+        for e in events:
+            event_id = e.get("id")
+            if not ((status := e.get("status")) and status.get("type") in _FINISHED):
+                continue
+            if event_id in seen_events:
+                continue
+            seen_events.add(event_id)
+            finished.append(e)
 
         new_items = []
-        purge_ids = set()
-
-        for i in range(0, len(finished), 8):
-            batch = finished[i:i+8]
-            results = await asyncio.gather(*[process_match(session, m) for m in batch])
-
-            for item, restricted in results:
-                if item:
-                    new_items.append(item)
-                purge_ids.update(restricted)
-
-            await asyncio.sleep(1)
-
-        merged = new_items + existing
-        final = []
-        seen = set()
-
-        for it in merged:
-            vid = get_yt_id(it.get("link", ""))
-            if vid in purge_ids:
+        purge_ids = load_purge_ids(CACHE_TTL)
+        now = time.time()
+
+        # Matches that already have an item still have their highlights polled so
+        # restrictions are caught, but skip incidents and new item creation
+        stored_ids = {it.get("match_id") for it in existing if it.get("match_id")}
+
+        results = await asyncio.gather(
+            *[process_match(session, sem, m, m.get("id") in stored_ids) for m in finished],
+            return_exceptions=True
+        )
+
+        errors = []
+        for match, result in zip(finished, results):
+            # A malformed event must not sink the whole run, but it must be visible
+            if isinstance(result, BaseException):
+                print(f"⚠️ Match {match.get('id')} failed: {result!r}")
+                errors.append(result)
                 continue
-            if it["link"] not in seen:
-                final.append(it)
-                seen.add(it["link"])
+            item, restricted = result
+            if item:
+                new_items.append(item)
+            for vid in restricted:
+                purge_ids.setdefault(vid, now)
+
+        # Every match failing points at a bug or an API change, not bad data
+        if finished and len(errors) == len(finished):
+            raise errors[0]
+
+        # Built oldest-first so the newest copy of each video is the one kept,
+        # then flipped back to newest-first
+        latest = {
+            vid: it
+            for it in chain(reversed(existing), reversed(new_items))
+            if (vid := get_yt_id(it.get("link", ""))) and vid not in purge_ids
+        }
+        final = list(latest.values())[::-1]
 
-        final.sort(key=lambda x: (is_priority_match(x), x["date"]), reverse=True)
+        # Rank and write in a worker thread while the session shuts down
+        persist = asyncio.create_task(asyncio.to_thread(save_highlights, final, FILE_PATH))
 
-        with open(FILE_PATH, "w", encoding="utf-8") as f:
-            json.dump(final, f, indent=2, ensure_ascii=False)
+    count = await persist
+    save_etags()
+    save_purge_ids(purge_ids)
 
-        print(f"✅ Highlights API updated → {len(final)} items")
+    print(f"✅ Highlights API updated → {count} items")
 
 if __name__ == "__main__":
     asyncio.run(main())